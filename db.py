@@ -1,8 +1,27 @@
+import queue
+import re
 import sqlite3
-from datetime import datetime
-from typing import List, Optional, Tuple
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
 
 DB_PATH = "/var/data/data.sqlite"
+POOL_SIZE = 5
+STATEMENT_CACHE_SIZE = 128
+BOOT_FETCH_CHUNK = 1000
+
+# Impostati una sola volta per connessione, quando viene aperta
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA cache_size=-65536;",
+    "PRAGMA foreign_keys=ON;",
+    "PRAGMA mmap_size=268435456;",
+    # scritture concorrenti (scheduler + handler): attende il lock invece di
+    # fallire subito con "database is locked"
+    "PRAGMA busy_timeout=5000;",
+)
 
 SCHEMA = """
 CREATE TABLE IF NOT EXISTS events (
@@ -10,62 +29,211 @@ CREATE TABLE IF NOT EXISTS events (
   user_id INTEGER NOT NULL,
   chat_id INTEGER NOT NULL,
   title TEXT NOT NULL,
+  title_norm TEXT, -- titolo normalizzato per il fuzzy match (vedi normalize_title)
   start_ts INTEGER NOT NULL, -- epoch seconds (UTC)
   created_ts INTEGER NOT NULL,
   updated_ts INTEGER NOT NULL
 );
-CREATE INDEX IF NOT EXISTS idx_events_user_start ON events(user_id, start_ts);
+-- indice coprente: le query sugli eventi futuri non leggono la tabella
+DROP INDEX IF EXISTS idx_events_user_start;
+CREATE INDEX IF NOT EXISTS idx_events_user_start_cov ON events(user_id, start_ts, title, title_norm);
+-- indice full-text sui titoli, sincronizzato con events dai trigger
+CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(
+  title, content='events', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS events_fts_ai AFTER INSERT ON events BEGIN
+  INSERT INTO events_fts(rowid, title) VALUES (new.id, new.title);
+END;
+CREATE TRIGGER IF NOT EXISTS events_fts_ad AFTER DELETE ON events BEGIN
+  INSERT INTO events_fts(events_fts, rowid, title) VALUES ('delete', old.id, old.title);
+END;
+CREATE TRIGGER IF NOT EXISTS events_fts_au AFTER UPDATE OF title ON events BEGIN
+  INSERT INTO events_fts(events_fts, rowid, title) VALUES ('delete', old.id, old.title);
+  INSERT INTO events_fts(rowid, title) VALUES (new.id, new.title);
+END;
 """
 
-def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA foreign_keys=ON;")
-    return conn
+# Query come costanti di modulo: stessa stringa ad ogni chiamata, così la
+# cache degli statement di sqlite3 riusa il piano già preparato.
+SQL_ADD = (
+    "INSERT INTO events (user_id, chat_id, title, title_norm, start_ts, created_ts, updated_ts) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_LIST_FUTURE = "SELECT id, title, title_norm, start_ts FROM events WHERE user_id=? AND start_ts>=? ORDER BY start_ts ASC"
+SQL_LIST_FUTURE_LIMITED = (
+    "SELECT id, title, start_ts FROM events WHERE user_id=? AND start_ts>=? ORDER BY start_ts ASC LIMIT ?"
+)
+SQL_UPDATE_TIME = "UPDATE events SET start_ts=?, updated_ts=? WHERE id=?"
+SQL_UPDATE_TITLE = "UPDATE events SET title=?, title_norm=?, updated_ts=? WHERE id=?"
+SQL_REMOVE = "DELETE FROM events WHERE id=?"
+SQL_FUTURE_WITH_LIKE = (
+    "SELECT id, title, title_norm, start_ts, (title LIKE ? ESCAPE '\\') AS matches_like "
+    "FROM events WHERE user_id=? AND start_ts>=? ORDER BY start_ts ASC"
+)
+SQL_FUTURE_REMINDERS = "SELECT chat_id, title, start_ts FROM events WHERE start_ts>=? ORDER BY start_ts ASC"
+SQL_COUNT_FUTURE = "SELECT COUNT(*) FROM events WHERE start_ts>=?"
+# stesse colonne di SQL_FUTURE_WITH_LIKE: ogni riga trovata contiene le parole cercate.
+# MATCH in una subquery: l'FTS gira una volta e guida la lettura (rowid -> events);
+# con una JOIN il planner può partire dall'indice su user_id e rifare il MATCH per ogni evento.
+SQL_FTS_SEARCH = (
+    "SELECT id, title, title_norm, start_ts, 1 AS matches_like FROM events "
+    "WHERE id IN (SELECT rowid FROM events_fts WHERE events_fts MATCH ?) "
+    "AND user_id=? AND start_ts>=? ORDER BY start_ts ASC LIMIT ?"
+)
+
+_FTS_TOKEN_RE = re.compile(r"\w+")
+
+class ConnectionPool:
+    """Pool of long-lived connections, opened once and reused across calls."""
+
+    def __init__(self, path: str, size: int = POOL_SIZE):
+        self._queue: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._queue.put(self._connect(path))
+
+    @staticmethod
+    def _connect(path: str) -> sqlite3.Connection:
+        # autocommit: ogni statement fuori da un BEGIN esplicito è già committato
+        conn = sqlite3.connect(
+            path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self._queue.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._queue.put(conn)
+
+_POOL: Optional[ConnectionPool] = None
+
+@contextmanager
+def get_conn() -> Iterator[sqlite3.Connection]:
+    global _POOL
+    if _POOL is None:
+        _POOL = ConnectionPool(DB_PATH)
+    with _POOL.connection() as conn:
+        yield conn
 
 def init_db():
     with get_conn() as c:
-        for stmt in SCHEMA.strip().split(";"):
-            s = stmt.strip()
-            if s:
-                c.execute(s)
+        has_fts = c.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='events_fts'"
+        ).fetchone()
+        # DB creato prima di title_norm: la colonna serve già all'indice in SCHEMA
+        columns = {row[1] for row in c.execute("PRAGMA table_info(events)")}
+        if columns and "title_norm" not in columns:
+            c.execute("ALTER TABLE events ADD COLUMN title_norm TEXT")
+        # executescript: i trigger contengono ';' e non si possono spezzare
+        c.executescript(SCHEMA)
+        if not has_fts:
+            # DB esistente: indicizza gli eventi già presenti
+            c.execute("INSERT INTO events_fts(events_fts) VALUES ('rebuild')")
+        rows = c.execute("SELECT id, title FROM events WHERE title_norm IS NULL").fetchall()
+        if rows:
+            c.executemany(
+                "UPDATE events SET title_norm=? WHERE id=?",
+                [(normalize_title(title), event_id) for event_id, title in rows],
+            )
+
+def normalize_title(title: str) -> str:
+    """
+    Forma usata per il confronto fuzzy; calcolata una volta in scrittura.
+    I titoli salvati sono già senza spazi ai bordi (strip() in main.handle_add),
+    strip() resta solo per le query dell'utente.
+    """
+    return title.strip().casefold()
 
 def add_event(user_id: int, chat_id: int, title: str, start_ts: int) -> int:
-    now = int(datetime.utcnow().timestamp())
+    """`title` arriva già ripulito da main.handle_add: qui non si rifà strip()."""
+    now = int(time.time())
     with get_conn() as c:
-        cur = c.execute(
-            "INSERT INTO events (user_id, chat_id, title, start_ts, created_ts, updated_ts) VALUES (?, ?, ?, ?, ?, ?)",
-            (user_id, chat_id, title.strip(), start_ts, now, now),
-        )
+        cur = c.execute(SQL_ADD, (user_id, chat_id, title, normalize_title(title), start_ts, now, now))
         return cur.lastrowid
 
 def list_all_future(user_id: int, now_ts: int) -> List[Tuple]:
     with get_conn() as c:
-        cur = c.execute(
-            "SELECT id, title, start_ts FROM events WHERE user_id=? AND start_ts>=? ORDER BY start_ts ASC",
-            (user_id, now_ts),
-        )
+        cur = c.execute(SQL_LIST_FUTURE, (user_id, now_ts))
+        return cur.fetchall()
+
+def list_future_limited(user_id: int, now_ts: int, limit: int = 50) -> List[Tuple]:
+    """Come list_all_future ma con LIMIT in SQL: per il recap basta la testa della lista."""
+    with get_conn() as c:
+        cur = c.execute(SQL_LIST_FUTURE_LIMITED, (user_id, now_ts, limit))
+        return cur.fetchall()
+
+def iter_future_reminders(now_ts: int, chunk_size: int = BOOT_FETCH_CHUNK) -> Iterator[Tuple]:
+    """
+    Eventi futuri di tutti gli utenti come (chat_id, title, start_ts), letti a
+    blocchi di `chunk_size` dentro un'unica transazione di lettura.
+    La connessione resta fuori dal pool finché il generatore non è esaurito.
+    """
+    with get_conn() as c:
+        c.execute("BEGIN")
+        try:
+            cur = c.execute(SQL_FUTURE_REMINDERS, (now_ts,))
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            c.commit()
+
+def count_future_events(now_ts: int) -> int:
+    with get_conn() as c:
+        return c.execute(SQL_COUNT_FUTURE, (now_ts,)).fetchone()[0]
+
+def _like_contains(text: str) -> str:
+    """Pattern LIKE 'contiene `text`': % e _ dell'utente restano caratteri letterali."""
+    safe = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{safe}%"
+
+def fetch_future_with_like(user_id: int, now_ts: int, title_query: str) -> List[Tuple]:
+    """
+    Eventi futuri come list_all_future, più una colonna matches_like (0/1) che
+    dice se il titolo contiene `title_query`: fuzzy e fallback LIKE lavorano
+    sulla stessa lettura.
+    """
+    with get_conn() as c:
+        cur = c.execute(SQL_FUTURE_WITH_LIKE, (_like_contains(title_query), user_id, now_ts))
         return cur.fetchall()
 
 def update_event_time(event_id: int, new_start_ts: int) -> None:
-    now = int(datetime.utcnow().timestamp())
+    now = int(time.time())
     with get_conn() as c:
-        c.execute("UPDATE events SET start_ts=?, updated_ts=? WHERE id=?", (new_start_ts, now, event_id))
+        c.execute(SQL_UPDATE_TIME, (new_start_ts, now, event_id))
 
 def update_event_title(event_id: int, new_title: str) -> None:
-    now = int(datetime.utcnow().timestamp())
+    now = int(time.time())
     with get_conn() as c:
-        c.execute("UPDATE events SET title=?, updated_ts=? WHERE id=?", (new_title.strip(), now, event_id))
+        c.execute(SQL_UPDATE_TITLE, (new_title, normalize_title(new_title), now, event_id))
 
 def remove_event(event_id: int) -> None:
     with get_conn() as c:
-        c.execute("DELETE FROM events WHERE id=?", (event_id,))
+        c.execute(SQL_REMOVE, (event_id,))
+
+def _fts_query(text: str) -> str:
+    """Ogni parola diventa un prefisso quotato: 'riun budg' -> '"riun"* "budg"*'."""
+    return " ".join(f'"{tok}"*' for tok in _FTS_TOKEN_RE.findall(text))
 
-def find_candidates_by_title(user_id: int, title_query: str, now_ts: int):
-    like = f"%{title_query.strip()}%"
+def find_candidates_by_title(user_id: int, title_query: str, now_ts: int, limit: int = 50):
+    """
+    Eventi futuri il cui titolo contiene (come prefisso) tutte le parole di `title_query`,
+    via indice FTS5. Righe nel formato di fetch_future_with_like.
+    """
+    match = _fts_query(title_query)
+    if not match:
+        return []
     with get_conn() as c:
-        cur = c.execute(
-            "SELECT id, title, start_ts FROM events WHERE user_id=? AND start_ts>=? AND title LIKE ? ORDER BY start_ts ASC",
-            (user_id, now_ts, like),
-        )
+        cur = c.execute(SQL_FTS_SEARCH, (match, user_id, now_ts, limit))
         return cur.fetchall()
@@ -1,10 +1,15 @@
 import os
+import re
+import secrets
+import sys
+import time
+import asyncio
 import logging
 from datetime import datetime
+from zoneinfo import ZoneInfo
 
-import pytz
 from dotenv import load_dotenv
-from rapidfuzz import fuzz
+from rapidfuzz import fuzz, process
 
 from telegram import Update
 from telegram.constants import ParseMode
@@ -17,55 +22,137 @@ logging.info("boot: main.py loaded")
 # ---- DB & NLP ----
 from db import (
     init_db,
-    get_conn,
+    count_future_events,
     add_event,
-    list_all_future,
+    list_future_limited,
+    iter_future_reminders,
+    fetch_future_with_like,
     find_candidates_by_title,
+    normalize_title,
     update_event_time,
     remove_event,
 )
 from nlp import (
-    detect_intent,
-    extract_datetime,
-    strip_date_from_title,
-    extract_move_targets,
-    extract_remove_target,
-    INTENT_ADD,
-    INTENT_RECAP,
-    INTENT_REMOVE,
-    INTENT_MOVE,
-    INTENT_HELP,
+    parse_message,
+    ParsedMessage,
+    Intent,
 )
 from scheduler import ReminderScheduler
 
 # -------------------- Costanti & util --------------------
 
 PENDING_KEY = "pending_action"
-ROME_TZ = pytz.timezone("Europe/Rome")
+NUM_RE = re.compile(r"^[1-5]$")  # risposta alla lista di disambiguazione
+ROME_TZ = ZoneInfo("Europe/Rome")
+UTC = ZoneInfo("UTC")
+# giorni della settimana in italiano, indicizzati come weekday()/tm_wday (lunedì=0):
+# la data si compone con f-string, senza strftime né locale
+WEEKDAYS = ("Lun", "Mar", "Mer", "Gio", "Ven", "Sab", "Dom")
+# fra due cambi d'ora europei passano almeno ~21 settimane (ott→mar)
+DST_MIN_GAP_S = 140 * 86400
+FUTURE_CACHE_TTL_S = 5.0
+
+# user_id -> (time.monotonic() della lettura, query normalizzata, righe)
+_future_cache: dict[int, tuple[float, str, list]] = {}
 
 
 def now_utc_ts() -> int:
-    """Epoch seconds in UTC (timezone-aware)."""
-    return int(datetime.now(pytz.UTC).timestamp())
+    """Epoch seconds in UTC."""
+    return int(time.time())
+
+
+def parse_update(update: Update) -> ParsedMessage:
+    """parse_message per l'update: router e handler condividono lo stesso risultato."""
+    text = (update.message.text or "").strip()
+    return parse_message(update.effective_chat.id, update.message.message_id, text)
 
 
 def fmt_event_line(title: str, ts: int) -> str:
-    dt = datetime.fromtimestamp(ts, tz=pytz.UTC).astimezone(ROME_TZ)
-    date_str = dt.strftime("%a %d/%m/%Y %H:%M")
-    return f"• {date_str} — {title}"
+    # fromtimestamp con il fuso di Roma converte in un passo, senza passare da UTC
+    dt = datetime.fromtimestamp(ts, tz=ROME_TZ)
+    return (
+        f"• {WEEKDAYS[dt.weekday()]} {dt.day:02d}/{dt.month:02d}/{dt.year} "
+        f"{dt.hour:02d}:{dt.minute:02d} — {title}"
+    )
+
+
+def _rome_offset(ts: int) -> int:
+    return int(datetime.fromtimestamp(ts, tz=ROME_TZ).utcoffset().total_seconds())
+
+
+def fmt_event_lines(rows) -> list[str]:
+    """
+    fmt_event_line per righe (id, title, start_ts) ordinate per start_ts.
+    Se tutto il blocco ha lo stesso offset UTC→Roma la conversione è una somma
+    intera + gmtime, senza un astimezone per riga.
+    """
+    if not rows:
+        return []
+    first_ts, last_ts = rows[0][2], rows[-1][2]
+    offset = _rome_offset(first_ts)
+    # stesso offset agli estremi e finestra più corta dell'intervallo minimo
+    # fra due cambi d'ora: nel mezzo non c'è stato nessun passaggio DST
+    if offset != _rome_offset(last_ts) or last_ts - first_ts > DST_MIN_GAP_S:
+        return [fmt_event_line(title, start_ts) for _id, title, start_ts in rows]
+    lines = []
+    for _id, title, start_ts in rows:
+        t = time.gmtime(start_ts + offset)
+        lines.append(
+            f"• {WEEKDAYS[t.tm_wday]} {t.tm_mday:02d}/{t.tm_mon:02d}/{t.tm_year} "
+            f"{t.tm_hour:02d}:{t.tm_min:02d} — {title}"
+        )
+    return lines
+
+
+def fetch_match_pool(user_id: int, query: str, now_ts: int):
+    """
+    Eventi futuri dell'utente con il flag LIKE per `query`, da passare a rank_matches.
+    Riusa per qualche secondo l'ultima lettura dello stesso utente con la stessa query.
+    """
+    q = normalize_title(query or "")
+    entry = _future_cache.get(user_id)
+    if entry and entry[1] == q and time.monotonic() - entry[0] < FUTURE_CACHE_TTL_S:
+        return [row for row in entry[2] if row[3] >= now_ts]
+    rows = fetch_future_with_like(user_id, now_ts, q)
+    _future_cache[user_id] = (time.monotonic(), q, rows)
+    return rows
+
+
+def invalidate_future_cache(user_id: int) -> None:
+    """Da chiamare dopo ogni add/remove/move dell'utente."""
+    _future_cache.pop(user_id, None)
 
 
 def find_best_matches(user_id: int, query: str, now_ts: int, limit: int = 5):
-    """Top match su titolo con RapidFuzz (soglia 60)."""
-    events = list_all_future(user_id, now_ts)
-    scored = []
-    q = (query or "").lower().strip()
-    for eid, title, start_ts in events:
-        score = fuzz.partial_ratio(q, title.lower())
-        if score >= 60:
-            scored.append((score, eid, title, start_ts))
-    scored.sort(reverse=True)
-    return [(eid, title, start_ts) for score, eid, title, start_ts in scored[:limit]]
+    """
+    Prima l'indice FTS, usato solo se basta da solo: più di `limit` titoli che
+    contengono le parole cercate e più di un candidato dopo il fuzzy, così l'utente
+    deve comunque scegliere da una lista. Altrimenti (pochi risultati, refusi,
+    parole parziali come "riunione" per "Riunioni") fuzzy su tutti gli eventi
+    futuri: un candidato unico, che remove/move applicano senza chiedere, esce
+    sempre dalla stessa ricerca completa di prima.
+    """
+    events = find_candidates_by_title(user_id, query or "", now_ts)
+    if len(events) > limit:
+        matches = rank_matches(events, query, limit)
+        if len(matches) > 1:
+            return matches
+    return rank_matches(fetch_match_pool(user_id, query, now_ts), query, limit)
+
+
+def rank_matches(events, query: str, limit: int = 5):
+    """
+    Top match su titolo con RapidFuzz (soglia 60), scoring e top-K in C.
+    Se il fuzzy non trova nulla, ripiega sui titoli che contengono la query
+    (LIKE), calcolati nella stessa SELECT.
+    """
+    q = normalize_title(query or "")
+    # title_norm è già normalizzato in DB: niente lower() per evento
+    titles = [title_norm for _eid, _title, title_norm, _start_ts, _like in events]
+    hits = process.extract(q, titles, scorer=fuzz.partial_ratio, score_cutoff=60, limit=limit)
+    if hits:
+        return [(events[idx][0], events[idx][1], events[idx][3]) for _title, _score, idx in hits]
+    return [(eid, title, start_ts) for eid, title, _title_norm, start_ts, like in events if like]
 
 
 # -------------------- Globals --------------------
@@ -102,16 +189,16 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    text = update.message.text
-
-    dt = extract_datetime(text, now_dt=datetime.now(ROME_TZ))
+    _intent, title, dt = parse_update(update)
     if not dt:
         await update.message.reply_text("Non ho capito la data/ora. Puoi ripetere? (es. 'venerdì alle 10')")
         return
 
-    title = strip_date_from_title(text) or "Evento"
-    start_ts = int(dt.astimezone(pytz.UTC).timestamp())
+    # unico punto di pulizia del titolo: add_event lo salva così com'è
+    title = title.strip() or "Evento"
+    start_ts = int(dt.timestamp())
     add_event(user_id, chat_id, title, start_ts)
+    invalidate_future_cache(user_id)
 
     if REM_SCHED:
         REM_SCHED.schedule_event_reminder(chat_id, title, start_ts)
@@ -125,34 +212,47 @@ async def handle_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_recap(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     now_ts = now_utc_ts()
-    events = list_all_future(user_id, now_ts)
+    events = list_future_limited(user_id, now_ts, limit=50)
     if not events:
         await update.message.reply_text("Agenda vuota da adesso in poi. ✨")
         return
     lines = ["🗓️ <b>Prossimi impegni</b>:", ""]
-    for _id, title, start_ts in events[:50]:
-        lines.append(fmt_event_line(title, start_ts))
+    lines.extend(fmt_event_lines(events))
     await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
 
 
+async def apply_remove(update: Update, event_id: int, title: str, start_ts: int):
+    """Unico punto di scrittura per la rimozione (conferma diretta o scelta numerica)."""
+    remove_event(event_id)
+    invalidate_future_cache(update.effective_user.id)
+    await update.message.reply_text(f"🗑️ Rimosso: {title} — {fmt_event_line(title, start_ts)[2:]}")
+
+
+async def apply_move(update: Update, event_id: int, title: str, old_ts: int, new_ts: int):
+    """Unico punto di scrittura per lo spostamento: DB, cache, promemoria, risposta."""
+    update_event_time(event_id, new_ts)
+    invalidate_future_cache(update.effective_user.id)
+    if REM_SCHED:
+        REM_SCHED.schedule_event_reminder(update.effective_chat.id, title, new_ts)
+
+    old_line = fmt_event_line(title, old_ts)
+    new_line = fmt_event_line(title, new_ts)
+    await update.message.reply_text(f"🔁 Spostato:<br><s>{old_line}</s><br>→ {new_line}", parse_mode=ParseMode.HTML)
+
+
 async def handle_remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    text = update.message.text
-
-    title_guess, dt = extract_remove_target(text)
+    _intent, title_guess, dt = parse_update(update)
     now_ts = now_utc_ts()
 
     candidates = []
     if title_guess:
         candidates = find_best_matches(user_id, title_guess, now_ts)
-        if not candidates:
-            candidates = find_candidates_by_title(user_id, title_guess, now_ts)
 
     if not candidates and dt:
-        t0 = int(dt.astimezone(pytz.UTC).timestamp())
-        all_upcoming = list_all_future(user_id, now_ts)
-        for _id, title, start_ts in all_upcoming:
+        t0 = int(dt.timestamp())
+        # se find_best_matches ha già letto la lista completa, arriva dalla cache
+        for _id, title, _title_norm, start_ts, _like in fetch_match_pool(user_id, title_guess, now_ts):
             if abs(start_ts - t0) <= 1800:
                 candidates.append((_id, title, start_ts))
 
@@ -171,17 +271,12 @@ async def handle_remove(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
         return
 
-    event_id, title, start_ts = candidates[0]
-    remove_event(event_id)
-    await update.message.reply_text(f"🗑️ Rimosso: {title} — {fmt_event_line(title, start_ts)[2:]}")
+    await apply_remove(update, *candidates[0])
 
 
 async def handle_move(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    text = update.message.text
-
-    title_guess, new_dt = extract_move_targets(text)
+    _intent, title_guess, new_dt = parse_update(update)
     if not new_dt:
         await update.message.reply_text("Non ho capito la nuova data/ora. Riprova es. 'sposta ... a martedì alle 11'.")
         return
@@ -190,8 +285,6 @@ async def handle_move(update: Update, context: ContextTypes.DEFAULT_TYPE):
     candidates = []
     if title_guess:
         candidates = find_best_matches(user_id, title_guess, now_ts)
-        if not candidates:
-            candidates = find_candidates_by_title(user_id, title_guess, now_ts)
 
     if not candidates:
         await update.message.reply_text("Non ho trovato quale evento spostare. Specifica meglio il titolo.")
@@ -201,7 +294,7 @@ async def handle_move(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data[PENDING_KEY] = {
             "type": "move",
             "candidates": candidates,
-            "new_ts": int(new_dt.astimezone(pytz.UTC).timestamp()),
+            "new_ts": int(new_dt.timestamp()),
         }
         lines = ["Quale evento vuoi spostare? Rispondi con <b>1-{}:</b>".format(min(5, len(candidates))), ""]
         for i, (_id, title, start_ts) in enumerate(candidates[:5], start=1):
@@ -209,23 +302,16 @@ async def handle_move(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
         return
 
-    event_id, title, old_ts = candidates[0]
-    new_ts = int(new_dt.astimezone(pytz.UTC).timestamp())
-    update_event_time(event_id, new_ts)
-    if REM_SCHED:
-        REM_SCHED.schedule_event_reminder(chat_id, title, new_ts)
-
-    old_line = fmt_event_line(title, old_ts)
-    new_line = fmt_event_line(title, new_ts)
-    await update.message.reply_text(f"🔁 Spostato:<br><s>{old_line}</s><br>→ {new_line}", parse_mode=ParseMode.HTML)
+    await apply_move(update, *candidates[0], int(new_dt.timestamp()))
 
 
 async def handle_numeric_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg = (update.message.text or "").strip()
-    if not msg.isdigit():
-        return
+    # prima il lookup sul dict (economico), poi la regex sul testo
     if PENDING_KEY not in context.user_data:
         return
+    msg = (update.message.text or "").strip()
+    if not NUM_RE.match(msg):
+        return
 
     choice = int(msg)
     pending = context.user_data[PENDING_KEY]
@@ -236,42 +322,34 @@ async def handle_numeric_choice(update: Update, context: ContextTypes.DEFAULT_TY
 
     event_id, title, ts = candidates[choice - 1]
     typ = pending.get("type")
-    chat_id = update.effective_chat.id
 
     if typ == "remove":
-        remove_event(event_id)
-        await update.message.reply_text(f"🗑️ Rimosso: {title} — {fmt_event_line(title, ts)[2:]}")
+        await apply_remove(update, event_id, title, ts)
     elif typ == "move":
         new_ts = pending.get("new_ts")
         if not new_ts:
             await update.message.reply_text("Non ho capito la nuova data/ora, riprova con 'sposta ... a ...'.")
             context.user_data.pop(PENDING_KEY, None)
             return
-        update_event_time(event_id, new_ts)
-        if REM_SCHED:
-            REM_SCHED.schedule_event_reminder(chat_id, title, new_ts)
-        old_line = fmt_event_line(title, ts)
-        new_line = fmt_event_line(title, new_ts)
-        await update.message.reply_text(f"🔁 Spostato:<br><s>{old_line}</s><br>→ {new_line}", parse_mode=ParseMode.HTML)
+        await apply_move(update, event_id, title, ts, new_ts)
 
     context.user_data.pop(PENDING_KEY, None)
 
 
+INTENT_HANDLERS = {
+    Intent.ADD: handle_add,
+    Intent.RECAP: handle_recap,
+    Intent.REMOVE: handle_remove,
+    Intent.MOVE: handle_move,
+    Intent.HELP: help_cmd,
+}
+
+
 async def fallback_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Router intent → handler specifico."""
-    text = (update.message.text or "").strip()
-    intent = detect_intent(text)
-
-    if intent == INTENT_ADD:
-        await handle_add(update, context); return
-    if intent == INTENT_RECAP:
-        await handle_recap(update, context); return
-    if intent == INTENT_REMOVE:
-        await handle_remove(update, context); return
-    if intent == INTENT_MOVE:
-        await handle_move(update, context); return
-    if intent == INTENT_HELP:
-        await help_cmd(update, context); return
+    handler = INTENT_HANDLERS.get(parse_update(update).intent)
+    if handler:
+        await handler(update, context); return
 
     await update.message.reply_text(
         "Dimmi se vuoi che <b>metta in agenda</b>, faccia un <b>recap</b>, <b>sposti</b> o <b>rimuova</b> qualcosa.",
@@ -286,44 +364,61 @@ async def ping_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def debug_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # niente PII nei log
-    now_utc = int(datetime.utcnow().timestamp())
-    with get_conn() as conn:
-        cur = conn.execute("SELECT COUNT(*) FROM events WHERE start_ts >= ?", (now_utc,))
-        cnt = cur.fetchone()[0]
+    now_utc = now_utc_ts()
+    cnt = count_future_events(now_utc)
     tz = os.getenv("TZ", "Europe/Rome")
+    utc_str = datetime.fromtimestamp(now_utc, tz=UTC).strftime("%Y-%m-%dT%H:%M:%S")
     await update.message.reply_text(
-        f"✅ Debug\n- TZ: {tz}\n- Eventi futuri: {cnt}\n- Ora UTC: {datetime.utcnow().isoformat()}Z"
+        f"✅ Debug\n- TZ: {tz}\n- Eventi futuri: {cnt}\n- Ora UTC: {utc_str}Z"
     )
 
 
 # -------------------- Scheduler bootstrap --------------------
 
+# Ordine al boot: bootstrap_scheduler (sync, prima del loop) ->
+# schedule_existing_reminders (riempie l'heap) -> run_polling/run_webhook ->
+# post_init=start_scheduler, che con il loop attivo avvia la consegna.
+
 def bootstrap_scheduler(app: Application) -> ReminderScheduler:
-    scheduler = ReminderScheduler(bot_send_callable=scheduler_send)
-    scheduler.start()
-    return scheduler
+    # niente start() qui: il loop non gira ancora, parte in start_scheduler
+    return ReminderScheduler(bot_send_callable=scheduler_send)
+
+
+async def start_scheduler(app: Application):
+    """post_init di PTB: il loop è attivo, parte il task che consegna i promemoria."""
+    if REM_SCHED:
+        await REM_SCHED.start()
 
 
 def schedule_existing_reminders():
     """All’avvio, riprogramma i promemoria per tutti gli eventi futuri."""
     if REM_SCHED is None:
         logging.error("schedule_existing_reminders: REM_SCHED is None"); return
-    now_ts = now_utc_ts()
-    with get_conn() as conn:
-        cur = conn.execute(
-            "SELECT id, chat_id, title, start_ts FROM events WHERE start_ts>=? ORDER BY start_ts ASC",
-            (now_ts,),
-        )
-        rows = cur.fetchall()
-        for event_id, chat_id, title, start_ts in rows:
-            REM_SCHED.schedule_event_reminder(chat_id, title, start_ts)
+    # una sola transazione per tutto il boot, righe lette a blocchi (niente fetchall())
+    REM_SCHED.schedule_event_reminders_batch(iter_future_reminders(now_utc_ts()))
 
 
 # -------------------- Entrypoint --------------------
 
+def install_uvloop():
+    """
+    Usa uvloop come event loop, se disponibile (non esiste su Windows).
+    Va chiamata prima che scheduler e run_polling creino il loop.
+    """
+    if sys.platform == "win32":
+        return
+    try:
+        import uvloop
+    except ImportError:
+        logging.info("uvloop non installato, uso il loop asyncio standard")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
 def main():
     global GLOBAL_APP, REM_SCHED
 
+    install_uvloop()
     load_dotenv()
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     if not token:
@@ -331,7 +426,7 @@ def main():
 
     init_db()
 
-    application = Application.builder().token(token).build()
+    application = Application.builder().token(token).post_init(start_scheduler).build()
     GLOBAL_APP = application
     REM_SCHED = bootstrap_scheduler(application)
 
@@ -341,9 +436,11 @@ def main():
     application.add_handler(CommandHandler("ping", ping_cmd))
     application.add_handler(CommandHandler("debug", debug_cmd))
 
-    # Prima il selettore numerico, poi il router generale
-    application.add_handler(MessageHandler(filters.Regex(r"^[1-5]$"), handle_numeric_choice))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, fallback_chat))
+    # Prima il selettore numerico, poi il router generale. Devono stare nello
+    # stesso gruppo: PTB esegue solo il primo handler che matcha nel gruppo,
+    # quindi una risposta "1"-"5" non passa mai da detect_intent.
+    application.add_handler(MessageHandler(filters.Regex(NUM_RE), handle_numeric_choice), group=0)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, fallback_chat), group=0)
 
     # Ripristina promemoria esistenti
     print("📍 boot: prima di schedule_existing_reminders()")
@@ -351,7 +448,24 @@ def main():
     print("📍 boot: dopo schedule_existing_reminders()")
 
     print("✅ Self Me AI — Agenda Bot avviato. Timezone:", os.getenv("TZ", "Europe/Rome"))
-    application.run_polling(close_loop=False)
+
+    # Su Render (o con PUBLIC_URL) Telegram ci spinge gli update via webhook;
+    # in locale, senza URL pubblico, resta il long-polling.
+    public_url = os.getenv("PUBLIC_URL") or os.getenv("RENDER_EXTERNAL_URL")
+    if not public_url:
+        application.run_polling(close_loop=False)
+        return
+
+    # path e secret non indovinabili; il webhook viene ri-registrato ad ogni avvio
+    secret_path = os.getenv("WH_PATH") or secrets.token_urlsafe(20)
+    application.run_webhook(
+        listen="0.0.0.0",
+        port=int(os.getenv("PORT", "8443")),
+        url_path=secret_path,
+        webhook_url=f"{public_url.rstrip('/')}/{secret_path}",
+        secret_token=os.getenv("WH_SECRET") or secrets.token_urlsafe(32),
+        close_loop=False,
+    )
 
 
 if __name__ == "__main__":
@@ -1,119 +1,330 @@
 import re
-from typing import Optional, Tuple
+from enum import IntEnum
+from functools import lru_cache
+from typing import NamedTuple, Optional, Tuple
 from dateparser.search import search_dates
-from datetime import datetime
-import pytz
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 
-ROME_TZ = pytz.timezone("Europe/Rome")
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# dateparser compila i suoi pattern al volo con il modulo `regex` (non `re`):
+# la cache di default (500 voci) si riempie già con l'italiano e i pattern
+# vengono ricompilati a ogni giro. Workaround: cache più grande.
+try:
+    import regex._main as _regex_main
+    _regex_main._MAXCACHE = max(_regex_main._MAXCACHE, 4096)
+except (ImportError, AttributeError):
+    pass
+
+ROME_TZ = ZoneInfo("Europe/Rome")
+
+# Costruiti una volta, non a ogni chiamata. dateparser tiene un'istanza di Settings
+# per ogni combinazione distinta (mai liberata): qui non vanno valori variabili
+# (es. RELATIVE_BASE).
+DATEPARSER_LANGUAGES = ["it"]
+DATEPARSER_SETTINGS = {"PREFER_DATES_FROM": "future", "TIMEZONE": "Europe/Rome"}
 
 # Etichette di intento
-INTENT_ADD = "add"
-INTENT_RECAP = "recap"
-INTENT_REMOVE = "remove"
-INTENT_MOVE = "move"
-INTENT_HELP = "help"
-INTENT_UNKNOWN = "unknown"
+class Intent(IntEnum):
+    UNKNOWN = 0
+    ADD = 1
+    RECAP = 2
+    REMOVE = 3
+    MOVE = 4
+    HELP = 5
 
-# Parole chiave in italiano
-ADD_KWS = ["metti in agenda", "in agenda", "in calendario", "aggiungi in agenda", "aggiungi in calendario", "segna in agenda"]
-RECAP_KWS = ["recap agenda", "cosa ho in agenda", "mostra agenda", "agenda", "calendario"]
-REMOVE_KWS = ["rimuovi", "cancella", "elimina", "togli"]
-MOVE_KWS = ["sposta", "ripianifica", "posticipa", "anticipa", "rimanda", "porta a"]
-HELP_KWS = ["/help", "aiuto"]
+INTENT_ADD = Intent.ADD
+INTENT_RECAP = Intent.RECAP
+INTENT_REMOVE = Intent.REMOVE
+INTENT_MOVE = Intent.MOVE
+INTENT_HELP = Intent.HELP
+INTENT_UNKNOWN = Intent.UNKNOWN
 
+# Parole chiave in italiano
+ADD_KWS = ("metti", "aggiungi", "inserisci", "crea", "ricorda", "ricordami")
+MOVE_KWS = ("sposta", "rimanda", "posticipa", "anticipa", "modifica")
+REMOVE_KWS = ("rimuovi", "cancella", "elimina")
 # Non includere "agenda" tra le parole del recap!
 RECAP_KWS = ("recap", "riepilogo", "mostra", "lista", "prossimi impegni")
+HELP_KWS = ("/help", "aiuto")
 
 # Riconosci frasi tipo "metti in agenda", "aggiungi in agenda"
 METTI_IN_AGENDA_RE = re.compile(r"\b(metti|aggiungi|inserisci|crea)\s+(in\s+)?agenda\b", re.IGNORECASE)
 
-ADD_KWS = ("metti", "aggiungi", "inserisci", "crea", "ricorda", "ricordami")
-MOVE_KWS = ("sposta", "rimanda", "posticipa", "anticipa", "modifica")
-REMOVE_KWS = ("rimuovi", "cancella", "elimina")
+# Regex usate a ogni messaggio: compilate una volta sola all'import
+_DROP_VERBS_RE = re.compile(
+    r"\b(sposta|rimanda|posticipa|anticipa|modifica|rimuovi|cancella|elimina|recap|riepilogo|mostra|lista)\b",
+    re.IGNORECASE,
+)
+_RELATIVE_RE = re.compile(
+    r"\b(oggi|domani|dopodomani|stamattina|pomeriggio|stasera|tra|fra|in)\b.*?(?=$|\ball[ea]\b|\bil\b|\bla\b|\bdi\b)",
+    re.IGNORECASE,
+)
+_TIME_RE = re.compile(r"\b(?:alle|ore|h)\s*\d{1,2}(?::\d{2})?\b", re.IGNORECASE)
+_DOW_RE = re.compile(r"\b(lunedì|martedì|mercoledì|giovedì|venerdì|sabato|domenica)\b", re.IGNORECASE)
+_DATE_RE = re.compile(r"\b\d{1,2}/\d{1,2}(?:/\d{2,4})?\b")
+_WS_RE = re.compile(r"\s+")
+_SPLIT_RE = re.compile(r"\b a | per | al ")
+
+def _fuse(*patterns) -> re.Pattern:
+    """Un'unica alternanza: a parità di posizione vince il pattern elencato prima."""
+    return re.compile("|".join(f"(?:{p.pattern})" for p in patterns), re.IGNORECASE)
+
+# strip_date_from_title in due passate invece di sei. Non una sola: togliere un verbo
+# può avvicinare "ore" al suo numero ("ore recap 9:30"), e _TIME_RE deve vederli
+# già uniti come nella versione a passate separate.
+_TITLE_VERBS_RE = _fuse(METTI_IN_AGENDA_RE, _DROP_VERBS_RE)
+_TITLE_DATES_RE = _fuse(_RELATIVE_RE, _TIME_RE, _DOW_RE, _DATE_RE)
+# equivalgono ai cicli `t.replace(kw, " ")` sulle liste di parole chiave (testo già minuscolo)
+_MOVE_KWS_RE = re.compile("|".join(re.escape(k) for k in MOVE_KWS))
+_REMOVE_KWS_RE = re.compile("|".join(re.escape(k) for k in REMOVE_KWS))
+
+# Parser veloce per le forme più comuni (oggi/domani/<giorno>/gg/mm[/aaaa] + alle HH[:MM]);
+# tutto il resto va a dateparser
+_IT_RELATIVE_DAYS = {"oggi": 0, "domani": 1, "dopodomani": 2}
+_IT_WEEKDAYS = {
+    "lunedì": 0, "lunedi": 0, "martedì": 1, "martedi": 1, "mercoledì": 2, "mercoledi": 2,
+    "giovedì": 3, "giovedi": 3, "venerdì": 4, "venerdi": 4, "sabato": 5, "domenica": 6,
+    # abbreviazioni, tranne "mar": dateparser la legge come marzo, resta a lui
+    "lun": 0, "mer": 2, "gio": 3, "ven": 4, "sab": 5, "dom": 6,
+}
+_IT_DT_RE = re.compile(
+    r"\b(?P<rel>oggi|domani|dopodomani)\b"
+    r"|\b(?P<dow>" + "|".join(_IT_WEEKDAYS) + r")(?!\w)"
+    r"|\b(?P<d>\d{1,2})/(?P<m>\d{1,2})(?:/(?P<y>\d{2,4}))?\b",
+    re.IGNORECASE,
+)
+_IT_TIME_RE = re.compile(
+    r"\b(?:alle|ore|h)\s*(?P<h>\d{1,2})(?:[:.](?P<mi>\d{2}))?\b|\b(?P<h2>\d{1,2}):(?P<mi2>\d{2})\b",
+    re.IGNORECASE,
+)
+# Espressioni che il parser veloce non gestisce: meglio lasciarle a dateparser
+_IT_FAST_BAIL_RE = re.compile(
+    r"\b(?:gennaio|febbraio|marzo|aprile|maggio|giugno|luglio|agosto|settembre|ottobre|novembre|dicembre"
+    r"|tra|fra|ieri|prossim\w*|settiman\w*|mese|mesi|anno|stamattina|stasera|stanotte|mattina"
+    r"|pomeriggio|sera|mezzogiorno|mezzanotte"
+    # abbreviazioni che dateparser riconosce e il parser veloce no (mar: martedì o marzo)
+    r"|mar|gen|feb|apr|mag|giu|lug|ago|set|ott|nov|dic)\b",
+    re.IGNORECASE,
+)
+_DIGIT_RE = re.compile(r"\d")
+
+# Parole che possono far parte di una data/ora in italiano: se un testo senza
+# cifre non ne contiene nessuna, non si chiama dateparser
+_TEMPORAL_HINTS = frozenset((
+    *_IT_RELATIVE_DAYS, *_IT_WEEKDAYS,
+    "gennaio", "febbraio", "marzo", "aprile", "maggio", "giugno", "luglio", "agosto",
+    "settembre", "ottobre", "novembre", "dicembre",
+    # abbreviazioni che dateparser riconosce
+    "lun", "mar", "mer", "gio", "ven", "sab", "dom",
+    "gen", "feb", "apr", "mag", "giu", "lug", "ago", "set", "ott", "nov", "dic",
+    "ieri", "alle", "ore", "ora", "tra", "fra", "stamattina", "stasera", "stanotte",
+    "mattina", "pomeriggio", "sera", "notte", "mezzogiorno", "mezzanotte",
+    "prossimo", "prossima", "prossimi", "prossime", "settimana", "settimane",
+    "giorno", "giorni", "mese", "mesi", "anno", "anni", "minuto", "minuti", "weekend",
+))
+_WORD_RE = re.compile(r"\w+")
+
+# ORDINE IMPORTANTE: add/move/remove prima del recap
+_INTENT_PRIORITY = (INTENT_ADD, INTENT_MOVE, INTENT_REMOVE, INTENT_RECAP, INTENT_HELP)
+
+# liste di parole chiave nello stesso ordine di _INTENT_PRIORITY
+_INTENT_KWS = (ADD_KWS, MOVE_KWS, REMOVE_KWS, RECAP_KWS, HELP_KWS)
+
+def _build_intent_automaton():
+    """Automa Aho-Corasick: tutte le parole chiave trovate in una sola passata in C."""
+    if ahocorasick is None:
+        return None
+    automaton = ahocorasick.Automaton()
+    for rank, kws in enumerate(_INTENT_KWS):
+        for kw in kws:
+            automaton.add_word(kw, rank)
+    automaton.make_automaton()
+    return automaton
+
+_INTENT_AC = _build_intent_automaton()
+
+def _best_intent_rank(t: str) -> int:
+    """Indice in _INTENT_PRIORITY della parola chiave più prioritaria in `t` (già casefold)."""
+    best = len(_INTENT_PRIORITY)
+    if _INTENT_AC is not None:
+        # l'automa è case-sensitive: parole chiave e testo sono entrambi minuscoli
+        for _end, rank in _INTENT_AC.iter(t):
+            best = min(best, rank)
+            if best == 0:
+                break
+        return best
+    # senza pyahocorasick: `in` per lista, in ordine di priorità. Più veloce di
+    # una regex con lookahead a ogni posizione, anche su testi lunghi
+    for rank, kws in enumerate(_INTENT_KWS):
+        if any(kw in t for kw in kws):
+            return rank
+    return best
 
-def detect_intent(text: str) -> str:
-    t = text.lower().strip()
+def detect_intent(text: str) -> Intent:
+    # risposte e retry identici sono frequenti: la chiave è il testo normalizzato
+    return _detect_intent_cached(text.casefold().strip())
 
-    # ORDINE IMPORTANTE: add/move/remove prima del recap
-    if METTI_IN_AGENDA_RE.search(t) or any(k in t for k in ADD_KWS):
-        return INTENT_ADD
-    if any(k in t for k in MOVE_KWS):
-        return INTENT_MOVE
-    if any(k in t for k in REMOVE_KWS):
-        return INTENT_REMOVE
+@lru_cache(maxsize=2048)
+def _detect_intent_cached(t: str) -> Intent:
+    best = _best_intent_rank(t)
+    if best < len(_INTENT_PRIORITY):
+        return _INTENT_PRIORITY[best]
 
     # Recap solo se esplicitamente richiesto (no match "agenda" generico)
-    if any(k in t for k in RECAP_KWS) or t in {"agenda", "agenda?"}:
+    if t in {"agenda", "agenda?"}:
         return INTENT_RECAP
 
     return INTENT_UNKNOWN
 
+@lru_cache(maxsize=512)
+def _search_dates_cached(text_lower: str, now_bucket: int) -> tuple:
+    """
+    search_dates memoizzato. `now_bucket` (minuto corrente) fa parte della chiave:
+    "domani" o "tra 2 ore" dipendono dall'ora, quindi il risultato vale al più un minuto.
+    `now_bucket` è solo chiave: dateparser legge l'orologio da sé, nel fuso di Roma
+    (TIMEZONE in DATEPARSER_SETTINGS) qualunque sia quello del server.
+    """
+    return tuple(search_dates(text_lower, languages=DATEPARSER_LANGUAGES, settings=DATEPARSER_SETTINGS) or ())
+
+def _it_fast_parse(text: str, now_dt: datetime) -> Optional[datetime]:
+    """
+    Data/ora per le forme semplici, senza dateparser. None se il testo contiene
+    altro che potrebbe essere una data (mesi, "tra 2 ore", numeri sparsi...).
+    """
+    if _IT_FAST_BAIL_RE.search(text):
+        return None
+    date_m = _IT_DT_RE.search(text)
+    time_m = _IT_TIME_RE.search(text)
+    if not date_m and not time_m:
+        return None
+    # numeri rimasti fuori dai match: non sappiamo cosa siano
+    if _DIGIT_RE.search(_IT_TIME_RE.sub(" ", _IT_DT_RE.sub(" ", text))):
+        return None
+
+    now = now_dt.astimezone(ROME_TZ)
+    hour, minute = 9, 0  # senza ora: 09:00
+    if time_m:
+        hour = int(time_m.group("h") or time_m.group("h2"))
+        minute = int(time_m.group("mi") or time_m.group("mi2") or 0)
+        if hour > 23 or minute > 59:
+            return None
+
+    def at(day) -> datetime:
+        return datetime(day.year, day.month, day.day, hour, minute, tzinfo=ROME_TZ)
+
+    today = now.date()
+    if not date_m:
+        # solo l'ora: oggi, o domani se è già passata
+        dt = at(today)
+        return dt if dt > now else at(today + timedelta(days=1))
+    if date_m.group("rel"):
+        return at(today + timedelta(days=_IT_RELATIVE_DAYS[date_m.group("rel").lower()]))
+    if date_m.group("dow"):
+        delta = (_IT_WEEKDAYS[date_m.group("dow").lower()] - today.weekday()) % 7
+        dt = at(today + timedelta(days=delta))
+        return dt if dt > now else at(today + timedelta(days=delta + 7))
+
+    day, month, year = int(date_m.group("d")), int(date_m.group("m")), date_m.group("y")
+    try:
+        if year:
+            year = int(year)
+            return at(datetime(year + 2000 if year < 100 else year, month, day))
+        dt = at(datetime(today.year, month, day))
+        return dt if dt.date() >= today else at(datetime(today.year + 1, month, day))
+    except ValueError:
+        return None  # es. 31/02
+
 def extract_datetime(text: str, now_dt: datetime) -> Optional[datetime]:
     """
     Estrae la prima data/ora plausibile dal testo in italiano.
     - Preferisce date future
     - Se non c'è l'ora, imposta 09:00
     - Ritorna timezone Europe/Rome
+    - `now_dt` guida solo il parser veloce; dateparser usa l'orologio (ora di Roma)
     """
-    results = search_dates(text, languages=['it'], settings={'PREFER_DATES_FROM': 'future'})
+    dt = _it_fast_parse(text, now_dt)
+    if dt is not None:
+        return dt
+    # scarto rapido: niente cifre e nessuna parola temporale, dateparser non troverebbe nulla
+    lower = text.lower()
+    if not _DIGIT_RE.search(lower) and _TEMPORAL_HINTS.isdisjoint(_WORD_RE.findall(lower)):
+        return None
+    results = _search_dates_cached(lower, int(now_dt.timestamp()) // 60)
     if not results:
         return None
     _, dt = results[0]
     # Normalizza timezone
     if dt.tzinfo is None:
-        dt = ROME_TZ.localize(dt)
+        dt = dt.replace(tzinfo=ROME_TZ)
     else:
         dt = dt.astimezone(ROME_TZ)
-    # Se non hai specificato l'ora nel testo, metti 09:00
-    has_time = bool(re.search(r"\b\d{1,2}(:\d{2})\b", text))
-    if dt.hour == 0 and dt.minute == 0 and not has_time:
+    # Se non hai specificato l'ora nel testo, metti 09:00. Basta guardare i pezzi
+    # riconosciuti da dateparser ("3 dicembre alle 0:00" ne dà due), non tutto il testo
+    if dt.hour == 0 and dt.minute == 0 and not any(":" in m for m, _dt in results):
         dt = dt.replace(hour=9, minute=0, second=0, microsecond=0)
     return dt
 
 def strip_date_from_title(text: str) -> str:
-    t = METTI_IN_AGENDA_RE.sub(" ", text)
-
-    # Rimuovi verbi di azione per non inquinare il titolo
-    t = re.sub(r"\b(sposta|rimanda|posticipa|anticipa|modifica|rimuovi|cancella|elimina|recap|riepilogo|mostra|lista)\b",
-               " ", t, flags=re.IGNORECASE)
+    # Rimuovi "metti in agenda" e i verbi di azione per non inquinare il titolo
+    t = _TITLE_VERBS_RE.sub(" ", text)
 
     # Heuristics per togliere riferimenti temporali comuni
-    t = re.sub(r"\b(oggi|domani|dopodomani|stamattina|pomeriggio|stasera|tra|fra|in)\b.*?(?=$|\ball[ea]\b|\bil\b|\bla\b|\bdi\b)",
-               " ", t, flags=re.IGNORECASE)
-    t = re.sub(r"\b(?:alle|ore|h)\s*\d{1,2}(?::\d{2})?\b", " ", t, flags=re.IGNORECASE)
-    t = re.sub(r"\b(lunedì|martedì|mercoledì|giovedì|venerdì|sabato|domenica)\b", " ", t, flags=re.IGNORECASE)
-    t = re.sub(r"\b\d{1,2}/\d{1,2}(?:/\d{2,4})?\b", " ", t)
+    t = _TITLE_DATES_RE.sub(" ", t)
 
     # Pulizia spazi
-    t = re.sub(r"\s+", " ", t).strip()
+    t = _WS_RE.sub(" ", t).strip()
     return t.title()
 
-def extract_move_targets(text: str) -> Tuple[Optional[str], Optional[datetime]]:
+def extract_move_targets(text: str, now_dt: datetime) -> Tuple[Optional[str], Optional[datetime]]:
     """
     Cerca 'titolo' e 'nuova data' da frasi tipo:
     'sposta riunione budget a lunedì alle 10'
     """
     lower = text.lower()
-    parts = re.split(r"\b a | per | al ", lower, maxsplit=1)
-    event_part = parts[0]
-    for kw in MOVE_KWS:
-        event_part = event_part.replace(kw, " ")
-    event_part = re.sub(r"\s+", " ", event_part).strip()
+    parts = _SPLIT_RE.split(lower, maxsplit=1)
+    event_part = _MOVE_KWS_RE.sub(" ", parts[0])
+    event_part = _WS_RE.sub(" ", event_part).strip()
     title_guess = event_part.title() if event_part else None
-    new_dt = extract_datetime(text, now_dt=datetime.now(ROME_TZ))
+    new_dt = extract_datetime(text, now_dt=now_dt)
     return title_guess, new_dt
 
-def extract_remove_target(text: str) -> Tuple[Optional[str], Optional[datetime]]:
+def extract_remove_target(text: str, now_dt: datetime) -> Tuple[Optional[str], Optional[datetime]]:
     """
     Prova a capire cosa rimuovere, accettando sia titolo che un orario specifico.
     Esempi: 'rimuovi visita commercialista', 'cancella evento di domani alle 15'
     """
-    lower = text.lower()
-    for kw in REMOVE_KWS:
-        lower = lower.replace(kw, " ")
-    lower = re.sub(r"\s+", " ", lower).strip()
-    dt = extract_datetime(lower, now_dt=datetime.now(ROME_TZ))
-    title_guess = strip_date_from_title(lower).title()
-    if title_guess == "":
-        title_guess = None
+    lower = _REMOVE_KWS_RE.sub(" ", text.lower())
+    lower = _WS_RE.sub(" ", lower).strip()
+    dt = extract_datetime(lower, now_dt=now_dt)
+    # strip_date_from_title restituisce già il titolo in Title Case
+    title_guess = strip_date_from_title(lower) or None
     return title_guess, dt
+
+class ParsedMessage(NamedTuple):
+    intent: Intent
+    title: Optional[str]
+    dt: Optional[datetime]
+
+@lru_cache(maxsize=1024)
+def parse_message(chat_id: int, msg_id: int, text: str) -> ParsedMessage:
+    """
+    Intento, titolo e data di un messaggio, calcolati una volta sola.
+    La chiave include (chat_id, msg_id): un update riconsegnato da Telegram
+    (retry del webhook) riusa il risultato invece di rifare il parsing.
+    """
+    intent = detect_intent(text)
+    # un solo "adesso" per tutto il parsing del messaggio
+    now_dt = datetime.now(ROME_TZ)
+    if intent == INTENT_ADD:
+        dt = extract_datetime(text, now_dt=now_dt)
+        return ParsedMessage(intent, strip_date_from_title(text), dt)
+    if intent == INTENT_MOVE:
+        return ParsedMessage(intent, *extract_move_targets(text, now_dt))
+    if intent == INTENT_REMOVE:
+        return ParsedMessage(intent, *extract_remove_target(text, now_dt))
+    return ParsedMessage(intent, None, None)
@@ -1,37 +1,107 @@
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.date import DateTrigger
-from datetime import datetime, timedelta
-import pytz
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
 
-ROME_TZ = pytz.timezone("Europe/Rome")
+ROME_TZ = ZoneInfo("Europe/Rome")
+REMIND_BEFORE_S = 10 * 60
+# se il loop 'salta' l'orario per pochi secondi, manda comunque
+MISFIRE_GRACE_S = 60
 
 class ReminderScheduler:
+    """
+    Promemoria raggruppati per secondo di scadenza (run_ts -> [(chat_id, text)]),
+    con un heap dei soli secondi: un unico task asyncio dorme fino al prossimo
+    e invia insieme tutto il gruppo.
+    """
+
     def __init__(self, bot_send_callable):
         # bot_send_callable: funzione async che invia un messaggio Telegram (chat_id, text)
-        self.scheduler = AsyncIOScheduler(timezone=ROME_TZ)
         self.bot_send = bot_send_callable
+        self._heap = []
+        self._buckets = {}
+        # svegliato a ogni inserimento: la nuova scadenza può essere la più vicina
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._sending = set()
 
-    def start(self):
-        if not self.scheduler.running:
-            self.scheduler.start()
+    async def start(self):
+        """
+        Avvia il task di consegna. Coroutine: si può chiamare solo con il loop
+        attivo (in main.py da post_init). I promemoria aggiunti prima aspettano
+        nell'heap e partono appena il task gira.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
 
     def schedule_event_reminder(self, chat_id: int, title: str, event_ts: int):
         """
         Pianifica un promemoria 10 minuti prima dell'evento.
         - event_ts è in secondi UTC (UNIX timestamp)
         """
-        event_dt = datetime.fromtimestamp(event_ts, tz=pytz.UTC).astimezone(ROME_TZ)
-        remind_dt = event_dt - timedelta(minutes=10)
-        now = datetime.now(ROME_TZ)
-        if remind_dt <= now:
+        self._add_reminder(chat_id, title, event_ts, time.time())
+        self._wakeup.set()
+
+    def schedule_event_reminders_batch(self, rows):
+        """
+        Come schedule_event_reminder, per un iterabile di righe (chat_id, title, event_ts),
+        anche un cursore sqlite3 ancora aperto. Un solo wakeup alla fine.
+        """
+        now_ts = time.time()
+        for chat_id, title, event_ts in rows:
+            self._add_reminder(chat_id, title, event_ts, now_ts)
+        self._wakeup.set()
+
+    def _add_reminder(self, chat_id: int, title: str, event_ts: int, now_ts: float):
+        run_ts = event_ts - REMIND_BEFORE_S
+        if run_ts <= now_ts:
             # Se l'orario del promemoria è già passato, non pianifico nulla
             return
+        # il datetime serve solo per il testo: dopo lo scarto, non prima
+        event_dt = datetime.fromtimestamp(event_ts, tz=ROME_TZ)
         text = f"⏰ Promemoria: '{title}' il {event_dt.strftime('%d/%m/%Y %H:%M')}"
-        self.scheduler.add_job(
-            self.bot_send,
-            trigger=DateTrigger(run_date=remind_dt),
-            args=[chat_id, text],
-            misfire_grace_time=60,  # se 'salta' l'orario per pochi secondi, manda comunque
-            coalesce=True,
-            max_instances=3,
+        bucket = self._buckets.get(run_ts)
+        if bucket is None:
+            self._buckets[run_ts] = [(chat_id, text)]
+            heapq.heappush(self._heap, run_ts)
+        else:
+            bucket.append((chat_id, text))
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            run_ts = self._heap[0]
+            delay = run_ts - time.time()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            bucket = self._buckets.pop(run_ts)
+            if -delay > MISFIRE_GRACE_S:
+                logging.warning("%d promemoria saltati: in ritardo di %.0fs", len(bucket), -delay)
+                continue
+            self._dispatch(bucket)
+
+    def _dispatch(self, bucket):
+        # un invio lento non deve ritardare i promemoria successivi
+        task = asyncio.get_running_loop().create_task(self._send_all(bucket))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send_all(self, bucket):
+        results = await asyncio.gather(
+            *(self.bot_send(chat_id, text) for chat_id, text in bucket),
+            return_exceptions=True,
         )
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error("invio promemoria fallito", exc_info=result)